@@ -1,22 +1,53 @@
 """ \author Tristan Israël (tristan.israel@alefbet.net) """
 
 from enum import StrEnum
+import os
 import json
-import threading
-import select
+import time
 import traceback
 from typing import Literal, Callable, Optional
 try:
     import serial
 except ImportError:
     pass
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import paho.mqtt.client as mqtt
-from paho.mqtt.reasoncodes import ReasonCode
-from paho.mqtt.properties import Properties
 from paho.mqtt.enums import CallbackAPIVersion, MQTTErrorCode
 
 DEBUG = False
 TYPE_CHECKING = True
+SERIAL_WRITE_SIZE = 64
+SERIAL_BUFFER_SIZE = 1024
+SERIAL_CLOSE_TIMEOUT = 0.5
+
+def json_dumps(payload:dict) -> bytes | str:
+    """ Serializes a payload, with orjson when it is available
+
+    json is used for the payloads that orjson rejects, such as integers over 64 bits.
+    Unlike json, orjson writes NaN and Infinity as null.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(payload)
+
+def json_loads(data:bytes) -> dict:
+    """ Deserializes the raw bytes of a message, with orjson when it is available
+
+    json is used for the payloads that orjson rejects, such as NaN and Infinity written by
+    json. Unlike json, orjson decodes the integers over 64 bits as floats.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
 
 class ConnectionType(StrEnum):
     ''' @brief This enumeration identifies the type of connection to the broker
@@ -29,14 +60,32 @@ class SerialSocket():
     ''' @brief This class implements a serial socket to an MQTT broker
 
     The serial socket is used to communicate on a serial port or a Unix domain socket
+
+    The port is read without timeout: a read returns the data already received by the driver,
+    and the low latency mode is enabled when the driver supports it. The remaining latency
+    depends on the kernel timer, a tickless kernel or HZ=1000 is recommended.
+
+    Small writes are gathered while the port is transmitting, so that they are sent together
+    instead of one transfer each. The data are written when the port is idle, when at least
+    :data:`SERIAL_WRITE_SIZE` bytes are waiting or when :meth:`flush` is called. At most
+    :data:`SERIAL_BUFFER_SIZE` bytes are gathered, :meth:`send` then behaves like a full
+    non-blocking socket so that paho keeps the packet queued.
     '''
 
     def __init__(self, path:str, baudrate:int):
         if DEBUG:
             print(f"Connect to serial port {path}")
-        self.serial = serial.Serial(port=path, baudrate=baudrate, timeout=1.0, write_timeout=0)
+        self.serial = serial.Serial(port=path, baudrate=baudrate, timeout=0, write_timeout=0)
+        try:
+            self.serial.set_low_latency_mode(True)
+        except (AttributeError, NotImplementedError, ValueError):
+            # ASYNC_LOW_LATENCY is only supported by some UART drivers on Linux
+            pass
         self.serial.reset_input_buffer()
         self.serial.reset_output_buffer()
+        # fileno() is called by select on each loop iteration
+        self.fd = self.serial.fileno()
+        self.write_buffer = bytearray()
 
 
     def recv(self, buffer_size: int) -> bytes:
@@ -44,130 +93,101 @@ class SerialSocket():
         if self.serial is not None and self.serial.is_open:
             data = self.serial.read(buffer_size)
             #print(f"Read {len(data)} bytes")
+            if not data:
+                # Behave like a non-blocking socket, an empty read means a closed socket for paho
+                raise BlockingIOError()
             return data
 
         return b''
 
-    def in_waiting(self) -> int:
-        return self.serial.in_waiting
-
-    def pending(self) -> int:
-        if self.serial is not None:
-            return self.serial.out_waiting
-        
-        return 0
-
     def send(self, buffer: bytes) -> int:
         if self.serial is not None and self.serial.is_open:
             #print("send:{}".format(buffer))
-            sent = self.serial.write(buffer)
-            return sent if sent is not None else 0
+            if len(self.write_buffer) >= SERIAL_BUFFER_SIZE:
+                self.flush()
+                if len(self.write_buffer) >= SERIAL_BUFFER_SIZE:
+                    raise BlockingIOError()
+
+            accepted = min(len(buffer), SERIAL_BUFFER_SIZE - len(self.write_buffer))
+            self.write_buffer += buffer[:accepted]
+            if len(self.write_buffer) >= SERIAL_WRITE_SIZE or self.serial.out_waiting == 0:
+                self.flush()
+            return accepted
         
         return 0
 
+    def flush(self) -> None:
+        ''' Writes the gathered data, as much as the port accepts without blocking '''
+        if self.write_buffer and self.serial is not None and self.serial.is_open:
+            # pyserial retries without waiting when a non-blocking write would block
+            try:
+                sent = os.write(self.fd, self.write_buffer)
+            except BlockingIOError:
+                return
+            del self.write_buffer[:sent]
+
     def close(self) -> None:     
         if self.serial is not None and self.serial.is_open:
-            self.serial.reset_input_buffer()
+            # paho closes the socket right after writing DISCONNECT, it is transmitted unless the
+            # peer has stopped reading, then the remaining data are discarded
+            self.__drain(SERIAL_CLOSE_TIMEOUT)
+            self.write_buffer.clear()
             self.serial.reset_output_buffer()
+            self.serial.reset_input_buffer()
             self.serial.close()
+        self.fd = -1
 
     def fileno(self) -> int:
-        return self.serial.fileno()
+        return self.fd
+
+    def __drain(self, timeout:float) -> None:
+        ''' Writes the gathered data and waits for their transmission, at most timeout seconds '''
+        deadline = time.monotonic() + timeout
+        while self.write_buffer or self.serial.out_waiting > 0:
+            if time.monotonic() >= deadline:
+                return
+            self.flush()
+            time.sleep(0.001)
 
     def setblocking(self, flag: bool) -> None:
         pass
 
 
 class SerialMQTTClient(mqtt.Client):
-    """ This class is used by the MQTT client to communicate on a serial port """    
-
-    on_connection_lost: Optional[Callable[[], None]] = None
+    """ This class is used by the MQTT client to communicate on a serial port 
+    
+    The serial port is opened as a :class:`SerialSocket` which is handled by the network loop
+    of paho like any other socket, including the reconnection.
+    """    
 
     def __init__(self, path:str, baudrate:int, *args, **kwargs):
         super().__init__(callback_api_version=CallbackAPIVersion.VERSION2, *args, **kwargs)
         self.path = path
         self.baudrate = baudrate
-        self._sock = None
-
-    def disconnect(self, reasoncode: ReasonCode | None = None, properties: Properties | None = None):
-        self._send_disconnect(reasoncode, properties)
-        self.__do_loop()
 
     def close(self):
         self.disconnect()
         self._sock_close()
 
-    def loop_start(self) -> MQTTErrorCode:
-        self._thread_terminate = False
-        self._thread = threading.Thread(target=self.__do_loop)
-        self._thread.daemon = True
-        self._thread.start()
-
-        return MQTTErrorCode.MQTT_ERR_SUCCESS
-
-    def __do_loop(self):
-        rc = MQTTErrorCode.MQTT_ERR_SUCCESS
-        timeout = 1.0
-
-        while not self._thread_terminate:
-            if self._sock is None:
-                print("No socket found, exiting loop")
-                if self.on_connection_lost is not None:
-                    self.on_connection_lost()
-                return
-            
-            # if bytes are pending do not wait in select
-            pending_bytes = self._sock.pending()
-            if pending_bytes > 0:
-                timeout = 0.0
-
-            rlist, _, _ = select.select([self._sock], [], [], timeout)
-
-            if rlist and self._sock.in_waiting() > 0:
-                rc = self.loop_read()
-                if rc != MQTTErrorCode.MQTT_ERR_SUCCESS:
-                    print(f"Read error {rc}")
-                    break
-
-            if self.want_write():
-                rc = self.loop_write()
-                if rc != MQTTErrorCode.MQTT_ERR_SUCCESS:
-                    print(f"Write error {rc}")
-                    break
-
-            rc = self.loop_misc()
-            if rc != MQTTErrorCode.MQTT_ERR_SUCCESS:
-                print(f"Misc error {rc}")
-                if rc == MQTTErrorCode.MQTT_ERR_CONN_LOST:
-                    print("Connection lost.")
-                    if self.on_connection_lost is not None:
-                        self.on_connection_lost()
-
-                break
-
-            #time.sleep(0.2)
-
-        print("MQTT loop ended")
+    def want_write(self) -> bool:
+        # The network loop waits for the port to be writable, then loop_misc writes the gathered data
+        return super().want_write() or (self._sock is not None and len(self._sock.write_buffer) > 0)
 
-    def loop_stop(self) -> MQTTErrorCode:
-        self._thread_terminate = True
+    def loop_misc(self) -> MQTTErrorCode:
+        # Called on each iteration of the network loop
+        if self._sock is not None:
+            self._sock.flush()
 
-        if self._thread is not None:
-            self._thread.join()
-            return MQTTErrorCode.MQTT_ERR_SUCCESS
-
-        return MQTTErrorCode.MQTT_ERR_UNKNOWN
+        return super().loop_misc()
 
     def _create_socket(self):
         try:
             print(f"Create socket on {self.path}")
-            self._sock = SerialSocket(self.path, self.baudrate)
-            self._sockpairR = self._sock
-            return self._sock
+            return SerialSocket(self.path, self.baudrate)
         except Exception as e:
             print("An error occured while opening the serial port")
             print(e)
-            return None
+            raise
 
 class MqttClient():
     """ This class is a client to an MQTT broker 
@@ -178,12 +198,8 @@ class MqttClient():
     connection_type:ConnectionType = ConnectionType.UNIX_SOCKET
     connection_string:str = ""
     identifier:str = "unknown"
-    on_connected: Optional[Callable[[], None]] = None
-    on_message: Optional[Callable[[str, dict], None]] = None
     on_subscribed: Optional[Callable[[], None]] = None
     on_log: Optional[Callable[[int, str], None]] = None
-    __message_callbacks = []
-    __connected_callbacks = []
     connected = False
     is_starting = False
     __debugging = False
@@ -206,10 +222,38 @@ class MqttClient():
         self.connection_string = connection_string
         self.__debugging = debugging
         self.__subscriptions = []
+        # Tuples are replaced, never mutated, so callbacks can be added or removed while dispatching
+        self.__message_callbacks: tuple[Callable[[str, dict], None], ...] = ()
+        self.__connected_callbacks: tuple[Callable[[], None], ...] = ()
+        self.__on_message_callback: Optional[Callable[[str, dict], None]] = None
+        self.__on_connected_callback: Optional[Callable[[], None]] = None
+        # on_message and on_connected followed by the added callbacks, called when dispatching
+        self.__message_handlers: tuple[Callable[[str, dict], None], ...] = ()
+        self.__connected_handlers: tuple[Callable[[], None], ...] = ()
 
     def __del__(self):
         self.stop()
 
+    @property
+    def on_message(self) -> Optional[Callable[[str, dict], None]]:
+        """ The callback called first when a message is received by the client """
+        return self.__on_message_callback
+
+    @on_message.setter
+    def on_message(self, callback:Optional[Callable[[str, dict], None]]):
+        self.__on_message_callback = callback
+        self.__update_message_handlers()
+
+    @property
+    def on_connected(self) -> Optional[Callable[[], None]]:
+        """ The callback called first when the connection is made to the broker """
+        return self.__on_connected_callback
+
+    @on_connected.setter
+    def on_connected(self, callback:Optional[Callable[[], None]]):
+        self.__on_connected_callback = callback
+        self.__update_connected_handlers()
+
     def start(self):
         """ Tries to connect to the MQTT broker if not already connected """
         if self.is_starting or self.connected:
@@ -260,7 +304,6 @@ class MqttClient():
             self.mqtt_client.on_message = self.__on_message
             self.mqtt_client.on_disconnect = self.__on_disconnected
             self.mqtt_client.on_subscribe = self.__on_subscribe
-            self.mqtt_client.on_connection_lost = self.__on_connection_lost
             if self.__debugging:
                 self.mqtt_client.on_log = self.__on_log
 
@@ -279,7 +322,8 @@ class MqttClient():
         The callback function has no argument
         """
 
-        self.__connected_callbacks.append(callback)
+        self.__connected_callbacks += (callback,)
+        self.__update_connected_handlers()
 
     def add_message_callback(self, callback):
         """ Adds a callback function that will be called when a message is received by the client 
@@ -288,16 +332,21 @@ class MqttClient():
           topic:str - The topic of the message
           payload:dict - The payload of the message
         """
-        self.__message_callbacks.append(callback)
+        self.__message_callbacks += (callback,)
+        self.__update_message_handlers()
 
     def del_message_callback(self, callback):
         """ Removes a message callback """
 
-        self.__message_callbacks.remove(callback)
+        callbacks = list(self.__message_callbacks)
+        callbacks.remove(callback)
+        self.__message_callbacks = tuple(callbacks)
+        self.__update_message_handlers()
 
     def reset_message_callbacks(self):
         """ Removes all messages callbacks """
-        self.__message_callbacks.clear()
+        self.__message_callbacks = ()
+        self.__update_message_handlers()
 
     def stop(self):
         """ Stops the MQTT client and disconnects from the broker """
@@ -338,11 +387,19 @@ class MqttClient():
     def publish(self, topic:str, payload:dict):
         """ Sends a new message """
         
-        data = json.dumps(payload)
+        data = json_dumps(payload)
         #print(data)
         #print(len(data))
         self.mqtt_client.publish(topic=topic, payload=data)
 
+    def __update_message_handlers(self):
+        first = () if self.__on_message_callback is None else (self.__on_message_callback,)
+        self.__message_handlers = first + self.__message_callbacks
+
+    def __update_connected_handlers(self):
+        first = () if self.__on_connected_callback is None else (self.__on_connected_callback,)
+        self.__connected_handlers = first + self.__connected_callbacks
+
     def __get_transport_type(self) -> Literal['tcp', 'unix']:
         if self.connection_type == ConnectionType.TCP_DEBUG:
             return "tcp"
@@ -356,11 +413,8 @@ class MqttClient():
     def __on_message(self, client:mqtt.Client, userdata, msg:mqtt.MQTTMessage):
         #print(f"[{userdata}] Message reçu sur {msg.topic}: {msg.payload.decode()}")        
         try:
-            payload = json.loads(msg.payload.decode())
-            if self.on_message is not None:
-                self.on_message(msg.topic, payload)
-
-            for cb in self.__message_callbacks:
+            payload = json_loads(msg.payload)
+            for cb in self.__message_handlers:
                 cb(msg.topic, payload)
         except Exception as e:
             print("[MQTT Client] Uncaught Exception when handling message:")
@@ -374,10 +428,7 @@ class MqttClient():
         self.connected = True
         self.is_starting = False
         
-        if self.on_connected is not None:
-            self.on_connected()
-
-        for cb in self.__connected_callbacks:
+        for cb in self.__connected_handlers:
             cb()
 
     def __on_subscribe(self, client, userdata, mid, reason_code_list, properties):
@@ -386,14 +437,9 @@ class MqttClient():
         if self.on_subscribed is not None:
             self.on_subscribed(mid)
 
-    def __on_connection_lost(self):
-        print("Connection lost, trying to reconnect.")
-        self.is_starting = False
-        self.connected = False
-        self.start()
-
     def __on_disconnected(self, *args):
         print("Disconnected from the broker")
+        self.connected = False
         #print("Arguments:")
         #for arg in args:
         #    print(arg)
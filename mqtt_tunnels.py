@@ -15,6 +15,9 @@
     On start the script begins monitoring the messaging sockets path. Each time a new file
     matching the filter is found a new tunnel is created.
 
+    The path is monitored with inotify when the `inotify_simple` package is available, otherwise
+    it is polled every second.
+
     When a new tunnel is created it consumes one of the broker sockets. The limit of tunnels is
     the number of broker sockets in the path.
 
@@ -22,27 +25,61 @@
     =======
 
     In a library the class :class:`UnixSocketTunneler` can be used to create a new tunnel between
-    two messaging sockets.
+    two messaging sockets. Its method :meth:`UnixSocketTunneler.tunnel` is a coroutine which must
+    be run in an asyncio event loop.
 
     Performance
     ===========
 
-    A thread is created for each tunnel. When the broker or the client closes the MQTT connection 
-    the tunnel and its thread are destroyed.
+    All the tunnels run in a single thread, as tasks of an asyncio event loop (uvloop is used when
+    available). Each direction of a connection is registered in the event loop, and unregistered
+    when the broker or the client closes the MQTT connection.
+
+    On Linux the data are moved between the sockets with splice(2) through a kernel pipe, so they
+    are never copied into user space. The data are copied by the tunnel when splice(2) is not
+    available or when debugging is enabled.
+
+    sendfile(2) cannot replace splice(2) here: Linux only accepts a file which can be mapped in
+    memory as its source, it fails with EINVAL when reading from a socket.
+
+    io_uring is not used: Python has no binding for it in its standard library and the splice(2)
+    path already keeps the data in the kernel, with one system call per direction.
 """
 
-import subprocess
+import os
 import time
-import threading
-import select
+import asyncio
 import socket
 import argparse
+import itertools
+import fcntl
+import queue
+import binascii
+from typing import Callable
+from fnmatch import fnmatch
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 BROKER_SOCKETS_PATH = "/var/run"
 MESSAGING_SOCKETS_PATH = "/tmp"
 MESSAGING_SOCKETS_FILTER = "*"
 
-BUFFER_SIZE = 4096
+BUFFER_SIZE = 65536
+# os.sendfile() is not an alternative, it cannot read from a socket
+SPLICE_SUPPORTED = hasattr(os, "splice")
+SPLICE_SIZE = 65536
+PIPE_SIZE = 1 << 20
+BUFFER_POOL = queue.LifoQueue()
+RETRY_DELAY_MIN = 0.1
+RETRY_DELAY_MAX = 30
+PRINTABLE = bytes(c if 32 <= c <= 126 else ord('.') for c in range(256))
+TUNNELS = set()
 DEBUG = False
 DEBUG_HEX = True
 
@@ -50,14 +87,263 @@ def hexdump(data, prefix=""):
     """ @brief Print binary data in hexdump format. """
     
 
+    # Both columns are computed once for the whole data, each line is a slice
+    hex_data = binascii.hexlify(data, " ").decode()
+    ascii_data = data.translate(PRINTABLE).decode()
+
     for i in range(0, len(data), 16):
-        chunk = data[i:i + 16]
-        hex_bytes = " ".join(f"{byte:02x}" for byte in chunk)
-        ascii_bytes = "".join(chr(byte) if 32 <= byte <= 126 else '.' for byte in chunk)
+        hex_bytes = hex_data[i * 3:i * 3 + 47]
+        ascii_bytes = ascii_data[i:i + 16]
         print(f"{prefix} {i:04x}: {hex_bytes:<48} {ascii_bytes}")
 
     print("EOF")
 
+async def wait_ready(read_fd:int | None, write_fd:int | None = None):
+    """ @brief Waits until a file descriptor is readable or another one is writable. """
+
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+
+    def set_ready():
+        if not ready.done():
+            ready.set_result(None)
+
+    if read_fd is not None:
+        loop.add_reader(read_fd, set_ready)
+    if write_fd is not None:
+        loop.add_writer(write_fd, set_ready)
+
+    try:
+        await ready
+    finally:
+        if read_fd is not None:
+            loop.remove_reader(read_fd)
+        if write_fd is not None:
+            loop.remove_writer(write_fd)
+
+class SplicePipe:
+    ''' @brief A kernel pipe used to move data from one socket to another with splice(2) '''
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        try:
+            fcntl.fcntl(self.write_fd, fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+        except OSError:
+            # The size is limited by /proc/sys/fs/pipe-max-size, keep the default one
+            pass
+        self.size = fcntl.fcntl(self.write_fd, fcntl.F_GETPIPE_SZ)
+        self.pending = 0
+        self.full = False
+
+    def is_full(self) -> bool:
+        return self.full or self.pending >= self.size
+
+    def fill(self, sock:socket.socket) -> int:
+        ''' Moves the data available on the socket into the pipe. Returns 0 when the socket is closed. '''
+        count = min(SPLICE_SIZE, self.size - self.pending)
+        try:
+            spliced = os.splice(sock.fileno(), self.write_fd, count, flags=os.SPLICE_F_NONBLOCK)
+        except BlockingIOError:
+            # The pipe holds a fixed number of pages and each small splice uses a whole one,
+            # so it can be full long before self.size bytes are pending
+            if self.pending:
+                self.full = True
+            raise
+        self.pending += spliced
+        return spliced
+
+    def drain(self, sock:socket.socket) -> int:
+        ''' Moves the data pending in the pipe to the socket '''
+        spliced = os.splice(self.read_fd, sock.fileno(), self.pending, flags=os.SPLICE_F_NONBLOCK)
+        self.pending -= spliced
+        if spliced:
+            self.full = False
+        return spliced
+
+    def release(self) -> None:
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+class CopyBuffer:
+    ''' @brief A fixed size ring buffer used to copy data from one socket to another
+
+    The data are received after the pending ones and sent from the oldest one. When the free
+    space or the pending data wrap around the end of the buffer they are received or sent as two
+    segments in a single system call (recvmsg_into and sendmsg), so the data are never moved.
+
+    The memory is taken from :data:`BUFFER_POOL` and given back by :meth:`release` so that
+    reconnecting tunnels do not allocate new buffers.
+    '''
+
+    def __init__(self):
+        try:
+            self.buffer = BUFFER_POOL.get_nowait()
+        except queue.Empty:
+            self.buffer = bytearray(BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.pending = 0
+
+    def release(self) -> None:
+        ''' Gives the memory back to the pool, the buffer must not be used anymore '''
+        self.view.release()
+        BUFFER_POOL.put_nowait(self.buffer)
+
+    def is_full(self) -> bool:
+        return self.pending == len(self.buffer)
+
+    def fill(self, sock:socket.socket) -> int:
+        ''' Receives the data available on the socket. Returns 0 when the socket is closed. '''
+        if not self.pending:
+            # Receive in one segment whenever possible
+            self.start = 0
+
+        size = len(self.buffer)
+        end = self.start + self.pending
+        if end < size:
+            segments = [self.view[end:], self.view[:self.start]] if self.start else [self.view[end:]]
+        else:
+            segments = [self.view[end - size:self.start]]
+
+        received = sock.recvmsg_into(segments, 0, socket.MSG_DONTWAIT)[0]
+        self.pending += received
+        return received
+
+    def drain(self, sock:socket.socket) -> int:
+        ''' Sends the pending data to the socket. Returns the number of bytes sent. '''
+        size = len(self.buffer)
+        end = self.start + self.pending
+        if end <= size:
+            segments = [self.view[self.start:end]]
+        else:
+            segments = [self.view[self.start:], self.view[:end - size]]
+
+        sent = sock.sendmsg(segments, [], socket.MSG_DONTWAIT)
+        self.start = (self.start + sent) % size
+        self.pending -= sent
+        return sent
+
+    def received_data(self, count:int) -> bytes:
+        ''' Returns a copy of the last data received, for debugging '''
+        return self.__copy(self.start + self.pending - count, count)
+
+    def sent_data(self, count:int) -> bytes:
+        ''' Returns a copy of the last data sent, for debugging '''
+        return self.__copy(self.start - count, count)
+
+    def __copy(self, position:int, count:int) -> bytes:
+        position %= len(self.buffer)
+        data = bytes(self.view[position:position + count])
+        if len(data) < count:
+            data += bytes(self.view[:count - len(data)])
+        return data
+
+class TunnelDirection:
+    ''' @brief Forwards the data of a tunnel from one socket to the other
+
+    The direction is registered in the event loop as the reader of its source socket while its
+    buffer has room, and as the writer of its destination socket while data are pending. The
+    registrations only change when the buffer becomes full or empty, the event loop then calls
+    the direction directly when its socket is ready.
+
+    The buffer is either a :class:`SplicePipe` or a :class:`CopyBuffer`. When the source socket
+    is closed, or on a socket error, the result or the exception is set on the `done` future.
+    '''
+
+    def __init__(self, src_sock:socket.socket, dst_sock:socket.socket, buffer, src_name:str, src_path:str, dst_path:str, done:asyncio.Future, debug_data:Callable | None = None):
+        self.loop = done.get_loop()
+        self.src_sock = src_sock
+        self.dst_sock = dst_sock
+        self.buffer = buffer
+        self.src_name = src_name
+        self.dst_name = "broker" if src_name == "client" else "client"
+        self.src_path = src_path
+        self.dst_path = dst_path
+        self.done = done
+        self.debug_data = debug_data
+        self.reading = False
+        self.writing = False
+
+    def start(self) -> None:
+        self.__update()
+
+    def stop(self) -> None:
+        if self.reading:
+            self.loop.remove_reader(self.src_sock.fileno())
+            self.reading = False
+        if self.writing:
+            self.loop.remove_writer(self.dst_sock.fileno())
+            self.writing = False
+
+    def on_readable(self) -> None:
+        try:
+            received = self.buffer.fill(self.src_sock)
+        except BlockingIOError:
+            # The buffer may have become full, stop reading until it is drained
+            self.__update()
+            return
+        except OSError as e:
+            self.__end(e)
+            return
+
+        if self.debug_data:
+            print(f"received {received} bytes from {self.src_name}")
+
+        if not received:
+            print(f"{self.src_name.capitalize()} socket closed on {self.src_path}.")
+            self.__end()
+            return
+
+        if self.debug_data:
+            self.debug_data(self.buffer.received_data(received), self.src_path, "proxy")
+
+        # The destination is usually ready, do not wait for the event loop
+        self.on_writable()
+
+    def on_writable(self) -> None:
+        if self.buffer.pending:
+            try:
+                sent = self.buffer.drain(self.dst_sock)
+
+                if self.debug_data:
+                    print(f"sent {sent} to {self.dst_name}")
+                    self.debug_data(self.buffer.sent_data(sent), "proxy", self.dst_path)
+            except BlockingIOError:
+                pass
+            except OSError as e:
+                self.__end(e)
+                return
+
+        self.__update()
+
+    def __update(self) -> None:
+        ''' Registers the direction for the events it can handle now '''
+
+        # Read only while the buffer has room
+        reading = not self.buffer.is_full()
+        if reading and not self.reading:
+            self.loop.add_reader(self.src_sock.fileno(), self.on_readable)
+        elif self.reading and not reading:
+            self.loop.remove_reader(self.src_sock.fileno())
+        self.reading = reading
+
+        # Write only when there are data to be sent
+        writing = self.buffer.pending > 0
+        if writing and not self.writing:
+            self.loop.add_writer(self.dst_sock.fileno(), self.on_writable)
+        elif self.writing and not writing:
+            self.loop.remove_writer(self.dst_sock.fileno())
+        self.writing = writing
+
+    def __end(self, error:OSError | None = None) -> None:
+        self.stop()
+        if self.done.done():
+            return
+        if error is not None:
+            self.done.set_exception(error)
+        else:
+            self.done.set_result(None)
+
 class UnixSocketTunneler:
     ''' @brief Creates a tunnel between two UNIX sockets 
     
@@ -72,129 +358,131 @@ class UnixSocketTunneler:
         self.client_socket_path = client_socket_path
         self.broker_socket_path = broker_socket_path
         self.n_socket = n_socket
+        self.__stop_event = asyncio.Event()
 
-    def tunnel(self, messaging_socket_path:str):
+    async def tunnel(self, messaging_socket_path:str):
         ''' @brief Setup connections and manage bidirectional tunneling.
         
         This function creates a new socket and waits for a connection on the local side. The
         connection to the remote is made only when the local side is connected.
+
+        When a connection fails or ends the tunnel is re-created after a delay which doubles
+        on each failure, from :data:`RETRY_DELAY_MIN` to :data:`RETRY_DELAY_MAX` seconds.
         '''
-        client_to_broker_buffer = b''
-        broker_to_client_buffer = b''
 
-        while True:
+        loop = asyncio.get_running_loop()
+        retry_delay = RETRY_DELAY_MIN
+
+        while not self.__stop_event.is_set():
             # The tunnel is re-created as much as necessary to stay alive
+            client_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            broker_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client_sock.setblocking(False)
+            broker_sock.setblocking(False)
 
             try:
-                # Create broker socket
-                broker_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-
                 # Connect to the client and wait for data
-                client_sock = self.__connect_to_client_socket_and_wait_for_data()
+                if not await self.__until_stopped(self.__connect_to_client_socket_and_wait_for_data(client_sock)):
+                    break
 
                 broker_socket_path = f"/tmp/mqtt_msg_{self.n_socket}.sock"
-                broker_sock.connect(broker_socket_path)
-                
-                while True:
-                    rlist = []
-                    wlist = []
-
-                    # Watch broker and client socket for incoming data
-                    rlist.append(client_sock)
-                    rlist.append(broker_sock)
-
-                    # Write only when there are data to be sent
-                    if client_to_broker_buffer:
-                        wlist.append(broker_sock)
-                    if broker_to_client_buffer:
-                        wlist.append(client_sock)
-
-                    readable, writable, _ = select.select(rlist, wlist, [])
-
-                    # If the client sent data
-                    if client_sock in readable:
-                        try:
-                            data = client_sock.recv(4096)
-                            if DEBUG:
-                                print(f"received {len(data)} bytes from client")
-
-                            if data:
-                                client_to_broker_buffer += data
-
-                                if DEBUG:
-                                    self.__debug_data(data, messaging_socket_path, "proxy")
-                            else:
-                                print(f"Client socket closed on {messaging_socket_path}.")
-                                break
-                        except BlockingIOError:
-                            pass
-
-                    # If the broker sent data
-                    if broker_sock in readable:
-                        try:
-                            data = broker_sock.recv(4096)
-                            if DEBUG:
-                                print(f"received {len(data)} bytes from broker")
-
-                            if data:
-                                broker_to_client_buffer += data
-                                if DEBUG:
-                                    self.__debug_data(data, broker_socket_path, "proxy")
-                            else:
-                                print(f"Broker socket closed on {broker_socket_path}.")
-                                break
-                        except BlockingIOError:
-                            pass
-
-                    # Send to the broker
-                    if broker_sock in writable and client_to_broker_buffer:
-                        try:
-                            sent = broker_sock.send(client_to_broker_buffer)
-                            
-                            if DEBUG:
-                                print(f"sent {sent} to broker")
-                                self.__debug_data(client_to_broker_buffer, "proxy", broker_socket_path)
-
-                            client_to_broker_buffer = client_to_broker_buffer[sent:]
-                        except BlockingIOError:
-                            pass
-
-                    # Send to the client
-                    if client_sock in writable and broker_to_client_buffer:
-                        try:
-                            sent = client_sock.send(broker_to_client_buffer)
-                            
-                            if DEBUG:
-                                print(f"sent {sent} to client")
-                                self.__debug_data(client_to_broker_buffer, "proxy", messaging_socket_path)
-
-                            broker_to_client_buffer = broker_to_client_buffer[sent:]
-                        except BlockingIOError:
-                            pass
+                await loop.sock_connect(broker_sock, broker_socket_path)
+                retry_delay = RETRY_DELAY_MIN
+
+                # Spliced data cannot be inspected
+                buffer_type = SplicePipe if SPLICE_SUPPORTED and not DEBUG else CopyBuffer
+                client_to_broker = None
+                broker_to_client = None
+
+                try:
+                    client_to_broker = buffer_type()
+                    broker_to_client = buffer_type()
+                    await self.__until_stopped(self.__forward_data(client_sock, broker_sock, client_to_broker, broker_to_client, messaging_socket_path, broker_socket_path))
+                finally:
+                    if client_to_broker is not None:
+                        client_to_broker.release()
+                    if broker_to_client is not None:
+                        broker_to_client.release()
                     
             except socket.error as e:
                 print(f"{self.client_socket_path} --> {self.broker_socket_path}. Socket error: {e}.")
             finally:
                 client_sock.close()
                 broker_sock.close()
-                client_to_broker_buffer = b''
-                broker_to_client_buffer = b''
-                time.sleep(1)  # Wait before retrying
 
-    def __connect_to_client_socket_and_wait_for_data(self) -> socket.socket:
+            # Wait before retrying
+            try:
+                await asyncio.wait_for(self.__stop_event.wait(), retry_delay)
+            except TimeoutError:
+                pass
+            retry_delay = min(retry_delay * 2, RETRY_DELAY_MAX)
+
+    def stop(self):
+        ''' @brief Stops the tunnel.
+
+        The tunnel ends immediately, its connection is closed if it is established. This
+        method must be called from the thread of the event loop.
+        '''
+        self.__stop_event.set()
+
+    async def __until_stopped(self, coroutine) -> bool:
+        ''' @brief Runs a coroutine until it returns or the tunnel is stopped.
+
+            Returns False when the tunnel has been stopped, the coroutine is then cancelled.
+        '''
+        loop = asyncio.get_running_loop()
+        task = loop.create_task(coroutine)
+        stopped = loop.create_task(self.__stop_event.wait())
+
+        try:
+            await asyncio.wait((task, stopped), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            stopped.cancel()
+            if not task.done():
+                task.cancel()
+                # The file descriptors are unregistered before the sockets are closed
+                await asyncio.wait((task,))
+
+        if task.cancelled():
+            return False
+
+        # Raises the socket error which ended the coroutine, if any
+        task.result()
+        return True
+
+    async def __forward_data(self, client_sock:socket.socket, broker_sock:socket.socket, client_to_broker, broker_to_client, messaging_socket_path:str, broker_socket_path:str):
+        ''' @brief Forwards data in both ways until one side is closed. '''
+
+        done = asyncio.get_running_loop().create_future()
+        # Read once, the debugging mode is not changed during a connection
+        debug_data = self.__debug_data if DEBUG else None
+
+        directions = [
+            TunnelDirection(client_sock, broker_sock, client_to_broker, "client", messaging_socket_path, broker_socket_path, done, debug_data),
+            TunnelDirection(broker_sock, client_sock, broker_to_client, "broker", broker_socket_path, messaging_socket_path, done, debug_data)
+        ]
+
+        try:
+            for direction in directions:
+                direction.start()
+
+            # Raises the socket error which ended the connection, if any
+            await done
+        finally:
+            for direction in directions:
+                direction.stop()
+
+    async def __connect_to_client_socket_and_wait_for_data(self, client_sock:socket.socket):
         ''' @brief Connects to the messaging socket and waits for data.
         
-            This function is blocking until a connection is made on the new socket.
+            This coroutine returns when the client has sent its first byte.
         '''
-        client_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        client_sock.connect(self.client_socket_path)
+        await asyncio.get_running_loop().sock_connect(client_sock, self.client_socket_path)
 
         print(f"Connected to {self.client_socket_path} and waiting for data")
 
-        ready_to_read, _, _ = select.select([client_sock], [], [])
-        if client_sock in ready_to_read:
-            print("Client has sent its first byte.")
-            return client_sock
+        await wait_ready(client_sock.fileno())
+        print("Client has sent its first byte.")
         
     def __debug_data(self, data, emitter, receiver):
         ''' Writes debugging information about the sockets communication '''
@@ -205,34 +493,60 @@ class UnixSocketTunneler:
             print(f"from {emitter} to {receiver}: {data}")
 
 
-def create_msg_tunnel(client_socket:str, n_socket:int):
+async def create_msg_tunnel(client_socket:str, n_socket:int):
     ''' Creates a new tunnel between two messaging sockets
     '''
 
     print(f"Creating new tunnel with client socket {client_socket} with ID {n_socket}.")
     tunneler = UnixSocketTunneler(client_socket, BROKER_SOCKETS_PATH, n_socket)
-    tunneler.tunnel(client_socket)
+    await tunneler.tunnel(client_socket)
+
+
+def has_broker_sockets() -> bool:
+    ''' Tells whether the MQTT broker has created at least one socket '''
+
+    try:
+        with os.scandir(BROKER_SOCKETS_PATH) as entries:
+            return next(entries, None) is not None
+    except FileNotFoundError:
+        return False
 
 
 def wait_for_broker_socket() -> bool:
     ''' Waits for the MQTT broker to create its sockets '''
 
     print("Waiting for MQTT Broker sockets...")
-    
-    cmd = f"find /var/run/ -name '{BROKER_SOCKETS_PATH}'"
 
-    while True:
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-        files = result.stdout.strip().split("\n")
-        
-        if len(files) == 0:
+    while not has_broker_sockets():
+        if INotify is None:
+            time.sleep(1)
+            continue
+
+        try:
+            with INotify() as inotify:
+                inotify.add_watch(BROKER_SOCKETS_PATH, flags.CREATE | flags.MOVED_TO)
+                while not has_broker_sockets():
+                    inotify.read()
+        except FileNotFoundError:
+            # The broker has not created the directory yet
             time.sleep(1)
-        else:
-            print("Broker sockets ready")
-            return True
 
+    print("Broker sockets ready")
+    return True
 
-def watch_msg_sockets():
+
+def start_msg_tunnel(client_socket:str, n_socket:int):
+    ''' Starts a new tunnel in the running event loop '''
+
+    print(f"New messaging socket found : {client_socket}")
+    task = asyncio.get_running_loop().create_task(create_msg_tunnel(client_socket, n_socket))
+
+    # The event loop only keeps weak references to its tasks
+    TUNNELS.add(task)
+    task.add_done_callback(TUNNELS.discard)
+
+
+async def watch_msg_sockets():
     ''' Monitors DomU sockets and starts a tunnel. 
     
         This functions looks for messaging sockets in the /var/run folder. When a new
@@ -240,24 +554,83 @@ def watch_msg_sockets():
     '''
     print("Looking for msg mqtt sockets")
 
-    cmd = f"find {MESSAGING_SOCKETS_PATH} -name '{MESSAGING_SOCKETS_FILTER}'"
+    n_sockets = itertools.count(1)
+
+    if INotify is None:
+        await poll_msg_sockets(n_sockets)
+        return
+
+    # A path keeps its tunnel for the life of the process, even when it is re-created
     sockets = set()
-    n_socket = 1
+
+    with INotify(nonblocking=True) as inotify:
+        while True:
+            try:
+                inotify.add_watch(MESSAGING_SOCKETS_PATH, flags.CREATE | flags.MOVED_TO | flags.DELETE_SELF)
+
+                # Sockets created while the path was not watched
+                with os.scandir(MESSAGING_SOCKETS_PATH) as entries:
+                    files = { entry.path for entry in entries if fnmatch(entry.name, MESSAGING_SOCKETS_FILTER) }
+            except FileNotFoundError:
+                # The messaging sockets path has not been created yet
+                await asyncio.sleep(1)
+                continue
+
+            for file in files - sockets:
+                start_msg_tunnel(file, next(n_sockets))
+
+            sockets.update(files)
+            await read_msg_sockets_events(inotify, sockets, n_sockets)
+
+
+async def read_msg_sockets_events(inotify, sockets:set, n_sockets:itertools.count):
+    ''' Starts a tunnel for each messaging socket notified by inotify
+
+        Returns when the watch has been removed or when events have been lost, the path must
+        then be watched and scanned again.
+    '''
 
     while True:
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-        files = result.stdout.strip().split("\n")
-        
-        new_files = set(files) - sockets
-        for file in new_files:
-            if file == "":
+        await wait_ready(inotify.fileno())
+
+        lost = False
+        for event in inotify.read(timeout=0):
+            if event.mask & (flags.Q_OVERFLOW | flags.DELETE_SELF | flags.IGNORED):
+                lost = True
+                continue
+
+            if not event.name or not fnmatch(event.name, MESSAGING_SOCKETS_FILTER):
+                continue
+
+            file = os.path.join(MESSAGING_SOCKETS_PATH, event.name)
+            if file in sockets:
                 continue
-            print(f"New messaging socket found : {file}")
-            threading.Thread(target=create_msg_tunnel, args=(file, n_socket)).start()
-            n_socket += 1
+
+            sockets.add(file)
+            start_msg_tunnel(file, next(n_sockets))
+
+        if lost:
+            return
+
+
+async def poll_msg_sockets(n_sockets:itertools.count):
+    ''' Polls the messaging sockets path when inotify is not available '''
+
+    sockets = set()
+
+    while True:
+        try:
+            with os.scandir(MESSAGING_SOCKETS_PATH) as entries:
+                files = { entry.path for entry in entries if fnmatch(entry.name, MESSAGING_SOCKETS_FILTER) }
+        except FileNotFoundError:
+            print(f"The messaging sockets path {MESSAGING_SOCKETS_PATH} does not exist")
+            files = set()
+
+        for file in files - sockets:
+            start_msg_tunnel(file, next(n_sockets))
 
         sockets.update(files)
-        time.sleep(1)
+        await asyncio.sleep(1)
 
 
 if __name__ == "__main__":
@@ -281,4 +654,7 @@ if __name__ == "__main__":
 
     wait_for_broker_socket()
 
-    threading.Thread(target=watch_msg_sockets).start()
+    if uvloop is not None:
+        uvloop.run(watch_msg_sockets())
+    else:
+        asyncio.run(watch_msg_sockets())